@@ -15,6 +15,8 @@ __project_repository__ = "https://github.com/newdaynewburner/dns-server"
 __dnsserverd_version__ = "0.1"
 __dnsserverctl_version__ = "0.1"
 
+_VALID_SETTINGS = frozenset(("zone_file", "override_file", "primary_upstream", "backup_upstream", "laddr", "lport", "ttl"))
+
 
 class DBusAPIClient(object):
     """ Client object for interacting with DBus API
@@ -132,10 +134,10 @@ if __name__ == "__main__":
             # Enable debugging output
             debug = True
 
-    for arg in args:
+    for i, arg in enumerate(args):
         if arg == "start":
-            if (args.index(arg) + 1) < len(args):
-                if args[args.index(arg) + 1] == "help":
+            if (i + 1) < len(args):
+                if args[i + 1] == "help":
                     print("Start the DNS server")
                     print("USAGE:")
                     print("\tdnsserverctl start")
@@ -143,24 +145,24 @@ if __name__ == "__main__":
             operations.append(("start", []))
 
         elif arg == "stop":
-            if (args.index(arg) + 1) < len(args):
-                if args[args.index(arg) + 1] == "help":
+            if (i + 1) < len(args):
+                if args[i + 1] == "help":
                     print("Stop the DNS server")
                     print("USAGE:")
                     print("\tdnsserverctl stop")
             operations.append(("stop", []))
 
         elif arg == "restart":
-            if (args.index(arg) + 1) < len(args):
-                if args[args.index(arg) + 1] == "help":
+            if (i + 1) < len(args):
+                if args[i + 1] == "help":
                     print("Restart the DNS server")
                     print("USAGE:")
                     print("\tdnsserverctl restart")
             operations.append(("restart", []))
 
         elif arg == "configure":
-            if (args.index(arg) + 2) <= (len(args) - 1) or (args.index(arg) + 1) == (len(args) - 1):
-                if args[args.index(arg) + 1] == "help":
+            if (i + 2) <= (len(args) - 1) or (i + 1) == (len(args) - 1):
+                if args[i + 1] == "help":
                     print("Change the value of a configuration setting")
                     print("USAGE:")
                     print("\tdnsserverctl [ OPTIONS ] configure { SETTING | help } VALUE")
@@ -168,10 +170,10 @@ if __name__ == "__main__":
                     print("\tOPTIONS := { -h, --help | -v, --version | -d, --debug }")
                     print("\tSETTING := { zone_file | override_file | primary_upstream | backup_upstream | laddr | lport | ttl }")
                     sys.exit(0)
-                elif args[args.index(arg) + 1] in ("zone_file", "override_file", "primary_upstream", "backup_upstream", "laddr", "lport", "ttl"):
-                    operations.append(("configure", [args[args.index(arg) + 1], args[args.index(arg) + 2]]))
+                elif args[i + 1] in _VALID_SETTINGS:
+                    operations.append(("configure", [args[i + 1], args[i + 2]]))
                 else:
-                    print(f"Invalid setting '{args[args.index(arg) + 1]}'! See 'dnsserverctl configure help' for a list of valid settings!")
+                    print(f"Invalid setting '{args[i + 1]}'! See 'dnsserverctl configure help' for a list of valid settings!")
                     sys.exit(1)
             else:
                 print("Error! Invalid usage! See -h or --help for usage information!")
@@ -16,11 +16,9 @@ def main(config, logger):
     """ Main function. Controls program execution
     """
     logger.info(f"Starting the DNS server service. DBus API is com.dnsserver.DNSServer")
-    try:
-        api.init_dbus_api()
-    except KeyboardInterrupt:
-        logger.info(f"Keyboard interupt recieved, stopping DNS server service now")
-        return None
+    api.init_dbus_api(config=config)
+    logger.info(f"Shutdown signal received, stopped DNS server service")
+    return None
             
 # Begin execution
 if __name__ == "__main__":
@@ -28,7 +26,10 @@ if __name__ == "__main__":
     config = configparser.ConfigParser()
     config.read(sys.argv[1])
 
-    # Set up the logger
+    # Set up the logger, skipping per-record thread/process lookups that the format never uses
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
     if bool(config["DNS"]["log_file"]):
         log_file = config["DNS"]["log_file"]
         if "~" in log_file:
@@ -36,13 +37,13 @@ if __name__ == "__main__":
         if not os.path.isdir(os.path.split(log_file)[0]):
             os.makedirs(os.path.split(log_file)[0])
         logging.basicConfig(
-            level=logging.DEBUG,
+            level=logging.INFO,
             format="%(asctime)s - %(levelname)s - [DNS Server] %(message)s",
             filename=log_file
         )
     else:
         logging.basicConfig(
-            level=logging.DEBUG,
+            level=logging.INFO,
             format="%(asctime)s - %(levelname)s - [DNS Server] %(message)s",
         )
     logger = logging.getLogger()
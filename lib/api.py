@@ -6,6 +6,7 @@ Contains the DBus API for the DNS server
 
 import os
 import sys
+import signal
 import subprocess
 import threading
 import logging
@@ -36,15 +37,29 @@ class DNSServerService(datatypes.DNSServer):
     """ System-level DBus API service
     """
 
-    def __init__(self):
+    _config_cache = None
+
+    def __init__(self, config=None):
         """ Initialize the object
         """
         self.version = "0.1"
-        config = configparser.ConfigParser()
-        config.read(sys.argv[1])
+        if config is None:
+            config = self._load_config(sys.argv[1])
         logger = logging.getLogger()
         super().__init__(config=config, logger=logger)
 
+    @classmethod
+    def _load_config(cls, path):
+        """ Parse the configuration file, reusing the previous parse if the file is unchanged
+        """
+        key = (path, os.stat(path).st_mtime_ns)
+        if cls._config_cache is not None and cls._config_cache[0] == key:
+            return cls._config_cache[1]
+        config = configparser.ConfigParser()
+        config.read(path)
+        cls._config_cache = (key, config)
+        return config
+
     ####################
     # DBUS API METHODS #
     ####################
@@ -95,10 +110,16 @@ class DNSServerService(datatypes.DNSServer):
     def State(self):
         return self.state
 
-def init_dbus_api(name=BUS_NAME, path=OBJECT_PATH, xml=INTERFACE_XML):
+def init_dbus_api(name=BUS_NAME, path=OBJECT_PATH, xml=INTERFACE_XML, config=None):
     """ Start the DBus API
     """
     bus = SystemBus()
-    bus.publish(name, (path, DNSServerService(), xml))
-    GLib.MainLoop().run()
+    service = DNSServerService(config=config)
+    bus.publish(name, (path, service, xml))
+    loop = GLib.MainLoop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, loop.quit)
+    loop.run()
+    if service.state == "running":
+        service.stop()
     return None
@@ -7,12 +7,248 @@ Custom datatype definitions
 import os
 import sys
 import subprocess
+import time
+import queue
+import itertools
+import functools
+import socket
+import struct
+import secrets
+import logging
+import selectors
+import threading
+import socketserver
 import configparser
-from dnslib import DNSRecord, QTYPE, RR, A, ZoneParser
+from collections import OrderedDict
+from dnslib import DNSRecord, QTYPE, CLASS, OPCODE, RCODE, RR, A, ZoneParser
 from dnslib.server import DNSServer as dnslib_DNSServer
-from dnslib.server import DNSHandler, BaseResolver
+from dnslib.server import DNSHandler, DNSLogger, BaseResolver
 from . import exceptions
 
+_VALID_SETTINGS = frozenset((
+    "zone_file",
+    "override_file",
+    "primary_upstream",
+    "backup_upstream",
+    "laddr",
+    "lport",
+    "ttl"
+))
+
+CACHE_MAX_ENTRIES = 1000
+CACHE_MAX_TTL = 3600
+NEGATIVE_CACHE_TTL = 60
+SERVFAIL_CACHE_TTL = 5
+REQUEST_QUEUE_SIZE = 4096
+FAST_WORKER_THREADS = 4
+MAX_UPSTREAM_THREADS = 256
+RCVBUF_SIZE = 4 << 20
+DROP_LOG_INTERVAL = 10
+UPSTREAM_TIMEOUT = 2.0
+UPSTREAM_STAGGER = 0.05
+
+# Interned names for common record types, looked up before falling back to dnslib's QTYPE Bimap
+_QTYPE_STR = {qtype: sys.intern(QTYPE[qtype]) for qtype in (1, 2, 5, 6, 12, 15, 16, 28, 33, 35, 41, 64, 65, 99, 255)}
+
+def domain_labels(name):
+    """ Normalize a domain name into a tuple of lowercase labels, TLD first
+    """
+    return tuple(reversed(name.lower().rstrip(".").split(".")))
+
+class DomainTrieNode(object):
+    """ Single node of a DomainTrie. Records for "*." names are kept in the wildcard slot of the
+    node for their suffix rather than under a "*" child
+    """
+
+    __slots__ = ("children", "records", "wildcard")
+
+    def __init__(self):
+        """ Initialize the object
+        """
+        self.children = {}
+        self.records = {}
+        self.wildcard = None
+
+class DomainTrie(object):
+    """ Resource record store keyed on reversed domain labels (TLD first)
+    """
+
+    def __init__(self):
+        """ Initialize the object
+        """
+        self.root = DomainTrieNode()
+
+    def insert(self, rr):
+        """ Add a resource record to the trie
+        """
+        labels = domain_labels(str(rr.rname))
+        is_wildcard = labels[-1] == "*"
+        node = self.root
+        for label in labels[:-1] if is_wildcard else labels:
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = DomainTrieNode()
+            node = child
+        if is_wildcard:
+            if node.wildcard is None:
+                node.wildcard = {}
+            records = node.wildcard
+        else:
+            records = node.records
+        records.setdefault(_QTYPE_STR.get(rr.rtype) or QTYPE[rr.rtype], []).append(rr)
+        records.setdefault("ANY", []).append(rr)
+        return None
+
+    def lookup(self, qlabels, qtype, wildcard=True):
+        """ Return the records matching the reversed query labels and type, preferring
+        exact matches over single-label "*." wildcard matches
+        """
+        node = self.root
+        for label in qlabels[:-1]:
+            node = node.children.get(label)
+            if node is None:
+                return None
+        exact = node.children.get(qlabels[-1])
+        if exact is not None and qtype in exact.records:
+            return exact.records[qtype]
+        if wildcard and node.wildcard is not None:
+            return node.wildcard.get(qtype)
+        return None
+
+def _parse_question(packet):
+    """ Read the reversed name labels and type of a single-question IN-class standard query straight
+    from the wire, without building dnslib objects. Returns None for anything else, or for names that
+    dnslib would escape, so the labels always match domain_labels(str(qname))
+    """
+    if len(packet) < 12:
+        return None
+    flags, qdcount = struct.unpack_from("!HH", packet, 2)
+    # Only QR=0 with opcode QUERY
+    if flags & 0xF800 or qdcount != 1:
+        return None
+    labels = []
+    offset = 12
+    try:
+        length = packet[offset]
+        while length:
+            if length > 63:
+                return None
+            label = packet[offset + 1:offset + 1 + length].decode("ascii")
+            if " " in label or "." in label or not label.isprintable():
+                return None
+            labels.append(label.lower())
+            offset += length + 1
+            length = packet[offset]
+        qtype, qclass = struct.unpack_from("!HH", packet, offset + 1)
+    except (IndexError, UnicodeDecodeError, struct.error):
+        return None
+    if qclass != 1:
+        return None
+    labels.reverse()
+    return tuple(labels) or ("",), qtype
+
+def _question_end(packet):
+    """ Return the offset just past the first question of a DNS message
+    """
+    offset = 12
+    while offset < len(packet) and packet[offset]:
+        offset += packet[offset] + 1
+    return offset + 5
+
+def _skip_name(packet, offset):
+    """ Return the offset just past the (possibly compressed) domain name starting at offset
+    """
+    while True:
+        length = packet[offset]
+        if length >= 0xC0:
+            return offset + 2
+        if not length:
+            return offset + 1
+        offset += length + 1
+
+def _record_offsets(packet):
+    """ Return the offset just past the question section of a DNS message, and the offsets of the TTL
+    fields of all its resource records except EDNS OPT pseudo-records
+    """
+    qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHH", packet, 4)
+    offset = 12
+    for _ in range(qdcount):
+        offset = _skip_name(packet, offset) + 4
+    question_end = offset
+    ttl_offsets = []
+    for _ in range(ancount + nscount + arcount):
+        offset = _skip_name(packet, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack_from("!HHIH", packet, offset)
+        if rtype != 41:
+            ttl_offsets.append(offset + 4)
+        offset += 10 + rdlength
+    return question_end, tuple(ttl_offsets)
+
+@functools.lru_cache(maxsize=8)
+def _load_zone(path, mtime_ns):
+    """ Parse a zone file into a DomainTrie. Cached on the file's modification time so a restart
+    only re-parses files that have changed
+    """
+    trie = DomainTrie()
+    with open(path, "r") as zone_file:
+        zone_parser = ZoneParser(zone_file)
+        for rr in zone_parser.parse():
+            trie.insert(rr)
+    return trie
+
+class ResponseCache(object):
+    """ TTL-bounded LRU cache of raw upstream responses
+    """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES):
+        """ Initialize the object
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, query):
+        """ Return the cached response for key rewritten as a reply to the raw query bytes, or None if
+        missing or expired. The reply takes the query's id and question spelling, and its TTLs are
+        counted down by the time spent in the cache
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expiry, stored_at, data, question_end, ttl_offsets = entry
+            now = time.monotonic()
+            if expiry <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+        response = bytearray(data)
+        response[0:2] = query[0:2]
+        if query[12:question_end].lower() == data[12:question_end].lower():
+            response[12:question_end] = query[12:question_end]
+        age = int(now - stored_at)
+        if age:
+            for offset in ttl_offsets:
+                ttl, = struct.unpack_from("!I", data, offset)
+                struct.pack_into("!I", response, offset, max(ttl - age, 0))
+        return response
+
+    def put(self, key, data, ttl):
+        """ Cache a response for ttl seconds (at most CACHE_MAX_TTL), evicting the least recently used
+        entry when full
+        """
+        try:
+            question_end, ttl_offsets = _record_offsets(data)
+        except (IndexError, struct.error):
+            return None
+        now = time.monotonic()
+        with self.lock:
+            self.entries[key] = (now + min(ttl, CACHE_MAX_TTL), now, data, question_end, ttl_offsets)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return None
+
 class DNSResolver(BaseResolver):
     """ DNS query resolver
     """
@@ -21,86 +257,292 @@ class DNSResolver(BaseResolver):
         """ Initialize the object
         """
         self.config = config
-        self.logger = logger
+        self.logger = logger or logging.getLogger()
         self.primary_upstream = self.config["DNS"]["primary_upstream"]
         self.backup_upstream = self.config["DNS"]["backup_upstream"]
         zone_file_path = self.config["DNS"]["zone_file"]
-        with open(zone_file_path, "r") as zone_file:
-            zone_parser = ZoneParser(zone_file)
-            self.dns_zone_records = list(zone_parser.parse())
+        self.dns_zone_trie = _load_zone(zone_file_path, os.stat(zone_file_path).st_mtime_ns)
         override_file_path = self.config["DNS"]["override_file"]
-        with open(override_file_path, "r") as override_file:
-            override_parser = ZoneParser(override_file)
-            self.dns_override_records = list(override_parser.parse())
-        self.query = 0
+        self.dns_override_trie = _load_zone(override_file_path, os.stat(override_file_path).st_mtime_ns)
+        self.cache = ResponseCache()
+        self.query = itertools.count()
+
+    def has_local_records(self, qlabels, qtype):
+        """ Check whether a query can be answered from the override or zone records
+        """
+        if self.dns_override_trie.lookup(qlabels, qtype):
+            return True
+        return bool(self.dns_zone_trie.lookup(qlabels, qtype, wildcard=False))
 
     def resolve(self, request, handler):
         """ Resolves DNS queries received by the server and returns a response
         """
 
-        def normalize(name):
-            """ Domain name normalization
-            """
-            return name.lower().rstrip(".") + "."
-
-        def wildcard_match(qname, rname):
-            """ Wildcard record matching
-            """
-            if not rname.startswith("*."):
-                return False
-            suffix = rname[2:]
-            if not qname.endswith(suffix):
-                return False
-            qlabels = qname.rstrip(".").split(".")
-            slabels = suffix.rstrip(".").split(".")
-            if len(qlabels) == len(slabels) + 1:
-                return True
-            else:
-                return False
-
-        # Get query name and type, along with client IP, then initialize an empty reply we will send back
-        # once the appropriate response is determined
-        qname = normalize(str(request.q.qname).rstrip("."))
-        qtype = QTYPE[request.q.qtype]
+        qid = next(self.query)
+
+        # Get query name and type, along with client IP. An empty reply is only built on the paths
+        # that answer locally; cached and upstream answers come back as ready-made records
+        qlabels = domain_labels(str(request.q.qname))
+        qtype = _QTYPE_STR.get(request.q.qtype) or QTYPE[request.q.qtype]
         client_ip = handler.client_address[0]
-        reply = request.reply()
 
         # Attempt resolution through override records
-        if self.dns_override_records:
-            exact_matches = []
-            wildcard_matches = []
-            for rr in self.dns_override_records:
-                if qtype not in (QTYPE[rr.rtype], "ANY"):
-                    continue
-                if qname == normalize(str(rr.rname)):
-                    exact_matches.append(rr)
-                elif wildcard_match(qname, normalize(str(rr.rname))):
-                    wildcard_matches.append(rr)
-            matches = exact_matches or wildcard_matches
-            if matches:
-                for rr in matches:
-                    reply.add_answer(rr)
-                self.query = self.query + 1
-                return reply
+        matches = self.dns_override_trie.lookup(qlabels, qtype)
+        if matches:
+            reply = request.reply()
+            reply.add_answer(*matches)
+            self.logger.debug("Query %d from %s for %s (%s) answered from override records", qid, client_ip, request.q.qname, qtype)
+            return reply
 
         # Attempt resolution through zone records
-        if self.dns_zone_records:
-            for rr in self.dns_zone_records:
-                if qtype in (QTYPE[rr.rtype], "ANY") and qname == normalize(str(rr.rname)):
-                    reply.add_answer(rr)
-                    reply.header.aa = 1
-                    self.query = self.query + 1
-                    return reply
+        matches = self.dns_zone_trie.lookup(qlabels, qtype, wildcard=False)
+        if matches:
+            reply = request.reply()
+            reply.add_answer(matches[0])
+            reply.header.aa = 1
+            self.logger.debug("Query %d from %s for %s (%s) answered from zone records", qid, client_ip, request.q.qname, qtype)
+            return reply
+
+        # Attempt resolution through previously cached upstream responses. The cache is keyed without
+        # the query class or header flags, so only IN-class standard queries may read or fill it
+        cache_key = (qlabels, qtype)
+        cacheable = request.q.qclass == CLASS.IN and not request.header.qr and request.header.opcode == OPCODE.QUERY
+        cached_response = self.cache.get(cache_key, request.pack()) if cacheable else None
+        if cached_response is not None:
+            response = DNSRecord.parse(cached_response)
+            self.logger.debug("Query %d from %s for %s (%s) answered from cache", qid, client_ip, request.q.qname, qtype)
+            return response
 
         # Resolve through upstream resolvers
+        upstream_response = self._forward(request)
+        if upstream_response is not None:
+            response = DNSRecord.parse(upstream_response)
+            if cacheable and response.header.rcode in (RCODE.NOERROR, RCODE.NXDOMAIN) and not response.header.tc:
+                if response.rr:
+                    ttl = min(rr.ttl for rr in response.rr)
+                else:
+                    # Negative answers are cached for the SOA minimum, as in RFC 2308
+                    ttl = min((min(rr.ttl, rr.rdata.times[4]) for rr in response.auth if rr.rtype == QTYPE.SOA), default=NEGATIVE_CACHE_TTL)
+                if ttl > 0:
+                    self.cache.put(cache_key, upstream_response, ttl)
+            self.logger.debug("Query %d from %s for %s (%s) answered by upstream", qid, client_ip, request.q.qname, qtype)
+            return response
+
+        # Answer SERVFAIL ourselves, and briefly remember it so a dead upstream is not retried for every query
+        reply = request.reply()
+        reply.header.aa = 0
+        reply.header.rcode = RCODE.SERVFAIL
+        if cacheable:
+            self.cache.put(cache_key, bytes(reply.pack()), SERVFAIL_CACHE_TTL)
+        self.logger.warning("Query %d from %s for %s (%s) failed, no upstream answered", qid, client_ip, request.q.qname, qtype)
+        return reply
+
+    def _forward(self, request):
+        """ Forward a query to the upstream resolvers under a fresh random id, so replies can only be
+        accepted by someone who saw the outgoing query, and return the reply with the client's id
+        """
+        client_id = request.header.id
+        request.header.id = secrets.randbits(16)
+        try:
+            upstream_response = self._exchange(request)
+        finally:
+            request.header.id = client_id
+        if upstream_response is None:
+            return None
+        return struct.pack("!H", client_id) + upstream_response[2:]
+
+    def _exchange(self, request):
+        """ Send a query to the upstream resolvers over UDP, sending to the backup shortly after the
+        primary and returning whichever reply arrives first. Falls back to TCP if neither answers or
+        the reply is truncated
+        """
+        data = request.pack()
+        question_end = _question_end(data)
+        pending = [self.primary_upstream, self.backup_upstream]
+        selector = selectors.DefaultSelector()
+        sockets = []
+        truncated_response = None
+        try:
+            deadline = time.monotonic() + UPSTREAM_TIMEOUT
+            next_send = time.monotonic()
+            while truncated_response is None:
+                now = time.monotonic()
+                if pending and now >= next_send:
+                    upstream = pending.pop(0)
+                    # A fresh socket per query keeps the source port unpredictable, and connecting
+                    # it resolves hostnames and lets the kernel drop datagrams from anyone else
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sockets.append(sock)
+                    try:
+                        sock.connect((upstream, 53))
+                        sock.setblocking(False)
+                        sock.send(data)
+                        selector.register(sock, selectors.EVENT_READ)
+                    except OSError:
+                        pass
+                    next_send = now + UPSTREAM_STAGGER
+                    deadline = max(deadline, now + UPSTREAM_TIMEOUT)
+                if now >= deadline:
+                    break
+                timeout = min(deadline, next_send) - now if pending else deadline - now
+                for key, _ in selector.select(max(timeout, 0)):
+                    try:
+                        upstream_response = key.fileobj.recv(8192)
+                    except OSError:
+                        continue
+                    if upstream_response[:2] != data[:2] or upstream_response[12:question_end] != data[12:question_end]:
+                        continue
+                    # TC flag set, retry over TCP for the full answer
+                    if upstream_response[2] & 0x02:
+                        truncated_response = upstream_response
+                        break
+                    return upstream_response
+        finally:
+            selector.close()
+            for sock in sockets:
+                sock.close()
+
         for upstream in (self.primary_upstream, self.backup_upstream):
             try:
-                upstream_response = request.send(upstream, 53, tcp=False)
-                self.query = self.query + 1
-                return DNSRecord.parse(upstream_response)
+                upstream_response = request.send(upstream, 53, tcp=True, timeout=UPSTREAM_TIMEOUT)
             except Exception:
                 continue
-        self.query = self.query + 1
+            if upstream_response[:2] == data[:2] and upstream_response[12:question_end] == data[12:question_end]:
+                return upstream_response
+        return truncated_response
+
+class QueuedUDPServer(socketserver.UDPServer):
+    """ UDP server whose socket reader only classifies and dispatches datagrams. Queries answerable
+    from the override/zone records or the response cache go to a fast worker pool. Everything else
+    gets its own thread for the upstream round trip, as with dnslib's threading server, so slow
+    upstreams neither stall local answers nor serialize other lookups
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler, logger=None):
+        """ Initialize the object
+        """
+        if ":" in server_address[0]:
+            self.address_family = socket.AF_INET6
+        super().__init__(server_address, handler)
+        # dnslib assigns its DNSLogger to self.logger once the server is built
+        self.server_logger = logger or logging.getLogger()
+        self.dropped = 0
+        self.next_drop_log = 0
+        self.fast_queue = queue.Queue(maxsize=REQUEST_QUEUE_SIZE)
+        self.upstream_slots = threading.BoundedSemaphore(MAX_UPSTREAM_THREADS)
+        self.stopping = False
+        self.workers = []
+        for _ in range(FAST_WORKER_THREADS):
+            worker = threading.Thread(target=self._worker, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def server_bind(self):
+        """ Enlarge the socket receive buffer before binding
+        """
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+        super().server_bind()
+        return None
+
+    def process_request(self, request, client_address):
+        """ Reply to cache hits directly, otherwise hand the datagram off to the fast workers or an
+        upstream thread, dropping it if either is at capacity
+        """
+        data, sock = request
+        question = _parse_question(data)
+        if question is not None:
+            qlabels, qtype = question
+            qtype = _QTYPE_STR.get(qtype) or QTYPE[qtype]
+            # Answer cache hits straight from the stored wire bytes
+            response = self.resolver.cache.get((qlabels, qtype), data)
+            if response is not None:
+                try:
+                    sock.sendto(response, client_address)
+                except OSError:
+                    pass
+                return None
+            is_local = self.resolver.has_local_records(qlabels, qtype)
+        else:
+            try:
+                query = DNSRecord.parse(data)
+                qlabels = domain_labels(str(query.q.qname))
+                qtype = _QTYPE_STR.get(query.q.qtype) or QTYPE[query.q.qtype]
+                # Packets the fast parser rejects never come from the cache
+                is_local = self.resolver.has_local_records(qlabels, qtype)
+            except Exception:
+                # Malformed queries are rejected by the handler without touching the network
+                is_local = True
+        if not is_local:
+            if not self.upstream_slots.acquire(blocking=False):
+                self._log_drop("too many upstream lookups in flight")
+                return None
+            threading.Thread(target=self._upstream_worker, args=(request, client_address), daemon=True).start()
+            return None
+        try:
+            self.fast_queue.put_nowait((request, client_address))
+        except queue.Full:
+            self._log_drop("request queue full")
+        return None
+
+    def _log_drop(self, reason):
+        """ Count a dropped query, reporting the count at most once every DROP_LOG_INTERVAL seconds so
+        an overloaded server is not also flooding its log
+        """
+        self.dropped += 1
+        now = time.monotonic()
+        if now >= self.next_drop_log:
+            self.server_logger.warning("Dropped %d queries since the last report, most recently because %s", self.dropped, reason)
+            self.dropped = 0
+            self.next_drop_log = now + DROP_LOG_INTERVAL
+        return None
+
+    def shutdown(self):
+        """ Stop the socket reader, discard queued queries nobody is waiting on any more, stop the
+        workers, then close the socket. Upstream threads still in flight are not waited for
+        """
+        super().shutdown()
+        self.stopping = True
+        while True:
+            try:
+                request, client_address = self.fast_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.shutdown_request(request)
+        for worker in self.workers:
+            self.fast_queue.put((None, None))
+        for worker in self.workers:
+            worker.join()
+        self.server_close()
+        return None
+
+    def _worker(self):
+        """ Fast worker thread loop
+        """
+        while True:
+            request, client_address = self.fast_queue.get()
+            if request is None:
+                return None
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def _upstream_worker(self, request, client_address):
+        """ Handle a single query that needs the upstream resolvers
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            # Replies that finish after shutdown have no socket left to go out on
+            if not self.stopping:
+                self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.upstream_slots.release()
 
 class DNSServer(object):
     """ DNS server
@@ -110,7 +552,7 @@ class DNSServer(object):
         """ Initialize the object
         """
         self.config = config
-        self.logger = logger
+        self.logger = logger or logging.getLogger()
         self.state = "not running"
         self.dns_server = None
 
@@ -118,7 +560,13 @@ class DNSServer(object):
         """ DNS server startup sequence
         """
         resolver = DNSResolver(config=self.config, logger=self.logger)
-        self.dns_server = dnslib_DNSServer(resolver, port=int(self.config["DNS"]["lport"]), address=self.config["DNS"]["laddr"])
+        # dnslib's default logger prints every request and reply with a strftime timestamp, so only
+        # enable those hooks when debug output is wanted and route everything through our logger
+        if self.logger.isEnabledFor(logging.DEBUG):
+            dns_logger = DNSLogger("request,reply,truncated,error", prefix=False, logf=self.logger.debug)
+        else:
+            dns_logger = DNSLogger("truncated,error", prefix=False, logf=self.logger.warning)
+        self.dns_server = dnslib_DNSServer(resolver, port=int(self.config["DNS"]["lport"]), address=self.config["DNS"]["laddr"], logger=dns_logger, server=functools.partial(QueuedUDPServer, logger=self.logger))
         self.dns_server.start_thread()
         self.state = "running"
         return None
@@ -173,15 +621,7 @@ class DNSServer(object):
     def configure(self, setting, value):
         """ Configure the DNS server
         """
-        if setting in (
-            "zone_file",
-            "override_file",
-            "primary_upstream",
-            "backup_upstream",
-            "laddr",
-            "lport",
-            "ttl"
-        ):
+        if setting in _VALID_SETTINGS:
             self.config["DNS"][setting] = value
         else:
             raise exceptions.ConfigurationError(f"Invalid setting '{setting}'!")